@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the Python and Numba search functions of perc_sim.py explore the same sequences in the same order.
+
+Both searches are run with the amino acids kept in order on the same small random grids. They must then follow
+the same paths, block the same cells, and give the same results, including the path length to the target if
+SIMULATION_TYPE = "Attempts". The check is run for every simulation type, type of transitions, and value of steps.
+"""
+import sys
+import numpy as np
+import perc_sim
+
+RUNS = 40                                       # Number of random grids checked for each set of parameters
+CHECK_PARAMS = [                                # Length, AA Num, Proportion, Tol, Steps
+    (7, 5, 0.22, 3, 1), (6, 6, 0.3, 2, 1),
+    (6, 5, 0.04, 2, 2), (6, 4, 0.08, 2, 2),
+    (5, 5, 0.012, 2, 3), (5, 4, 0.03, 1, 3)]
+
+
+#############################################
+# Return True if the Python and Numba searches give the same results on runs random grids
+def check_searches(length, aanum, proportion, tol, steps, runs, rng):
+    mat = np.empty((aanum,)*length, dtype=np.uint8)
+    initial_seq = [0]*length
+    target_aa = 1
+    target_min = length - tol
+    for run in range(runs):
+        perc_sim.initialize(mat, rng, proportion)
+        grid, grid_nb = mat.reshape(-1).copy(), mat.reshape(-1).copy()
+        pathinfo, pathinfo_nb = perc_sim.PathInfo(), perc_sim.PathInfo()
+        perc_sim.SEARCH_PATHS[steps](grid, length, aanum, target_min, initial_seq, target_aa, -1, pathinfo, None)
+        perc_sim.search_path_numba(perc_sim.SEARCH_PATHS_NB[steps], grid_nb, length, aanum, target_min, initial_seq,
+                                   target_aa, -1, pathinfo_nb, None)
+        if pathinfo != pathinfo_nb or not np.array_equal(grid, grid_nb):
+            return(False)
+    return(True)
+
+
+if __name__ == '__main__':
+    if not perc_sim.NUMBA_INSTALLED:
+        sys.exit("numba is not installed")
+    rng = np.random.default_rng()
+    failed = 0
+    for simulation_type in perc_sim.SIMULATION_TYPES:
+        perc_sim.SIMULATION_TYPE = simulation_type
+        for transitions in ["All", "Reduced"]:
+            perc_sim.TRANSITIONS = transitions
+            for length, aanum, proportion, tol, steps in CHECK_PARAMS:
+                same = check_searches(length, aanum, proportion, tol, steps, RUNS, rng)
+                failed += not same
+                print("%s, %s, length %d, %d amino acids, proportion %g, tol %d, steps %d: %s" % (simulation_type,
+                      transitions, length, aanum, proportion, tol, steps, "same" if same else "DIFFERENT"))
+    if failed:
+        sys.exit("Python and Numba searches differ for %d sets of parameters" % failed)
+    print("Python and Numba searches agree")
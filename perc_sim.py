@@ -23,11 +23,19 @@ It can equal 1, 2, or 3.
 import multiprocessing
 import numpy as np
 import pandas as pd
-import random
 import sys
 import os.path
 from os import getpid
-import math 
+from functools import partial
+from dataclasses import dataclass
+try:
+    from numba import njit
+    NUMBA_INSTALLED = True
+except ImportError:
+    NUMBA_INSTALLED = False
+    # Leave the Numba search functions uncompiled. They are not used without numba.
+    def njit(*args, **kwargs):
+        return(lambda func: func)
 
 COLUMNS_CLUSTER = ['Length', 'AA Num', 'Process', 'PID', 'Proportion', 'Cluster'] 
 COLUMNS_CLAV = ['Length', 'AA Num', 'Proportion', 'Cluster Ave', 'STD', 'Trials'] 
@@ -35,6 +43,7 @@ COLUMNS_PERC_LARGE = ['Length', 'AA Num', 'Process', 'PID', 'Proportion', 'Size'
 COLUMNS_PLGAV = ['Length', 'AA Num', 'Proportion', 'Perc Large', 'STD', 'Trials'] 
 COLUMNS_ATTEMPTS = ['Length', 'AA Num', 'Process', 'PID', 'Proportion', 'Attempts', 'Path Len'] 
 COLUMNS_ATTAV = ['Length', 'AA Num', 'Proportion', 'Attempts Ave', 'Att STD', 'Path Len Ave', 'Len STD', 'Trials'] 
+SIMULATION_TYPES = ['Cluster', 'Percent', 'Attempts']
 
 PARALLEL_PROC = 2                               # Number of parallel processes
 PATH_MAX = 15000                                # Maximum path length for average attempts and average cluster size
@@ -43,8 +52,11 @@ CLUSTER_MAX = 20000                             # Maximum cluster size for % lar
 
 SIMULATION_TYPE = "Percent"                     # Type of simulation: "Cluster", "Percent", or "Attempts"
 TRANSITIONS = "All"                             # Allowed transitions: "All", "Reduced"
+REDUCED_SHIFTS = [-2, -1, 1, 2]                 # Amino acid shifts allowed at a position if TRANSITIONS = "Reduced"
+GRID = "Dense"                                  # Grid storage: "Dense" (every cell drawn upfront), "Sparse" (cells drawn when first reached)
+USE_NUMBA = True                                # Search dense grids with Numba-compiled functions if numba is installed
+SEED = None                                     # Seed for reproducible trials, or None to seed from fresh entropy
 TRIALS_PARAMS_FILE = "trials_params.csv"        # Name of file with parameter values for trials
-PROCESS_FILE_BASE = "process"                   # File name base for output of processes
 CL_OUTPUT_FILE = "output_cl.csv"                # Name of output file for individual cluster output
 CLAV_OUTPUT_FILE = "output_clav.csv"            # Name of output file for average cluster output
 PLG_OUTPUT_FILE = "output_plg.csv"              # Name of output file for individual % large cluster output
@@ -54,345 +66,582 @@ ATTAV_OUTPUT_FILE = "output_attav.csv"          # Name of output file for averag
 
 
 #############################################
-# Create new data file if needed
-def test_datafile(file_name, column_names):
-    df = pd.DataFrame(columns = column_names)
-    # Check if file exists. If not, create it.
-    if os.path.exists(file_name) == False:
-        df.to_csv(file_name, encoding='utf-8', index=False)
-        return
-    
-    # check if file column names are correct. If not, create new file with correct names.
-    data = pd.read_csv(file_name)
-    if data.columns.values.tolist() != column_names:
-        df.to_csv(file_name, encoding='utf-8', index=False)
-        
-    return
+# Strides of the flat grid of sequences of length positions. Changing the amino acid at position pos by 1 changes the
+# index of a sequence by strides[pos].
+def grid_strides(length, aanum):
+    return([aanum**(length-1-pos) for pos in range(length)])
 
 
 #############################################
-# Create grid of dimensions length and size aa with random values
-def initialize(length, aa):
-    if length == 7:
-        mat = np.random.rand(aa,aa,aa,aa,aa,aa,aa)
-        mat[1][1][1][1][1][1][1] = 0
-    elif length == 8:
-        mat = np.random.rand(aa,aa,aa,aa,aa,aa,aa,aa)
-        mat[1][1][1][1][1][1][1][1] = 0
-    elif length == 9:
-        mat = np.random.rand(aa,aa,aa,aa,aa,aa,aa,aa,aa)
-        mat[1][1][1][1][1][1][1][1][1] = 0
-    elif length == 10:
-        mat = np.random.rand(aa,aa,aa,aa,aa,aa,aa,aa,aa,aa)
-        mat[1][1][1][1][1][1][1][1][1][1] = 0
-    elif length == 11:
-        mat = np.random.rand(aa,aa,aa,aa,aa,aa,aa,aa,aa,aa,aa)
-        mat[1][1][1][1][1][1][1][1][1][1][1] = 0
-    elif length == 12:
-        mat = np.random.rand(aa,aa,aa,aa,aa,aa,aa,aa,aa,aa,aa,aa)
-        mat[1][1][1][1][1][1][1][1][1][1][1][1] = 0
-    elif length == 13:
-        mat = np.random.rand(aa,aa,aa,aa,aa,aa,aa,aa,aa,aa,aa,aa,aa)
-        mat[1][1][1][1][1][1][1][1][1][1][1][1][1] = 0
-    else:
-        print("Dimension %d not included" % length)
-        sys.exit("\n")
-    return(mat)
+# Fill grid mat in place. Cells of functional sequences, whose random values are smaller than proportion, are set to 0 
+# and all other cells to 1. Random values are drawn as float32 into one reused buffer, a slice of the grid at a time, 
+# to limit temporary memory.
+def initialize(mat, rng, proportion):
+    values = np.empty(mat[0].size, dtype=np.float32)
+    proportion = np.float32(proportion)
+    for mat_slice in mat.reshape(mat.shape[0], -1):
+        np.greater_equal(rng.random(dtype=np.float32, out=values), proportion, out=mat_slice)
+    mat[(1,)*mat.ndim] = 0
 
 
 #############################################
-# Check if sequences differ by no more than tol
-def check_same(list1, list2, tol):
-    same = True
-    dif = 0
-    for i in range(len(list1)):
-        if list1[i] != list2[i]:
-            dif += 1
-    if dif > tol:
-        same = False
-    return(same)
-        
+# Grid that only decides whether a sequence is functional when its cell is first read. Cells are keyed by 
+# flat index and, like the dense grid, hold 0 for functional, unvisited sequences and 1 otherwise. 
+class SparseGrid(dict):
+    def __init__(self, rng, proportion):
+        super().__init__()
+        self.rng = rng
+        self.proportion = proportion
+
+    def __missing__(self, idx):
+        value = self[idx] = int(self.rng.random() >= self.proportion)
+        return(value)
+
 
 #############################################
-# Retrieve value in matrix at position corresponding to seq
-def retrieve(mat, seq, length):
-    if length == 1:
-        value = mat[seq[0]] 
-        return value
-    else:
-        return(retrieve(mat[seq[0]], seq[1:], length-1))
+# Create the flat grid searched in a trial. If GRID = "Dense", refill mat and return a flat view of it. 
+# If GRID = "Sparse", return a new SparseGrid with a functional target cell as in the dense grid.
+def new_grid(mat, length, aanum, rng, proportion):
+    if GRID == "Dense":
+        initialize(mat, rng, proportion)
+        return(mat.reshape(-1))
+    grid = SparseGrid(rng, proportion)
+    grid[sum(grid_strides(length, aanum))] = 0
+    return(grid)
 
 
 #############################################
-# Set value of cell designated by seq to 1 to make cell impassable
-def block_path(mat, seq, length):
-    if length == 1:
-        mat[seq[0]] = 1
-    else:
-        block_path(mat[seq[0]], seq[1:], length-1)
-    
-    
+# Results of the searches of a trial, updated as sequences are added to paths
+@dataclass(slots=True)
+class PathInfo:
+    cluster: int = 0                    # Number of sequences in the cluster of the start sequence
+    large: bool = False                 # True once the cluster reaches CLUSTER_MAX
+    path_found: bool = False            # True once a path reaches the target
+    path_len_target: int = 0            # Length of the path that reached the target
+
+
 #############################################
-# Recursively traverse paths through grid
-def search_path(mat, length, aanum, proportion, steps, tol, seq, target_seq, pathlen, pathinfo):
-    # Block sequence from becoming part of other paths. 
-    block_path(mat, seq, length)
-    pathlen += 1
-    
-    # Check if path length > PATH_MAX. Simulation crashes if path becomes too large. 
-    if pathlen > PATH_MAX:
-        return
-    
+# Check if seq lies inside the target, i.e. at least target_min positions hold target_aa
+def check_same(seq, target_aa, target_min):
+    return(seq.count(target_aa) >= target_min)
+        
+
+#############################################
+# Update pathinfo for a sequence added to a path. Return True if all searches should end.
+def record_seq(seq, pathlen, target_min, target_aa, pathinfo):
     # Check type of simulation to determine next actions
     if SIMULATION_TYPE == "Cluster":
-        pathinfo["Cluster"] += 1        # Increment cluster size by 1
+        pathinfo.cluster += 1           # Increment cluster size by 1
     elif SIMULATION_TYPE == "Percent":
-        # Check if cluster size exceeds CLUSTER_MAX indicating large cluster.
-        if pathinfo["Size"] == "Large":
-            return
-        pathinfo["Cluster"] += 1        # Increment cluster size by 1
-        # Check if cluster size exceeds CLUSTER_MAX. If so, set pathinfo["Cluster Max"] to True
-        if pathinfo["Cluster"] >= CLUSTER_MAX:
-            pathinfo["Size"] = "Large"
-            return
+        pathinfo.cluster += 1           # Increment cluster size by 1
+        # Check if cluster size exceeds CLUSTER_MAX. If so, set pathinfo.large and end all searches
+        if pathinfo.cluster >= CLUSTER_MAX:
+            pathinfo.large = True
+            return True
     elif SIMULATION_TYPE == "Attempts":
-        if pathinfo["Path Found"] == True:
-            return
         # Check it target found. If found, record pathlen and end all searches
-        if check_same(seq, target_seq, tol):
-            pathinfo["Path Found"] = True
-            pathinfo["Path Len Target"] = pathlen
-            return
+        if check_same(seq, target_aa, target_min):
+            pathinfo.path_found = True
+            pathinfo.path_len_target = pathlen
+            return True
+    return False
+
+
+#############################################
+# Draw n random orderings of the amino acids at once by shuffling each of the first n rows of aa_rows. Rows are
+# converted to lists only as they are used, since the orderings of every sequence on the current path are kept.
+def shuffle_aas(rng, aa_rows, n):
+    # Keep the amino acids in order if rng is None (see check_searches.py)
+    if rng is None:
+        return(map(np.ndarray.tolist, aa_rows[:n]))
+    return(map(np.ndarray.tolist, rng.permuted(aa_rows[:n], axis=1)))
+
+
+#############################################
+# Traverse paths through a flat grid (see new_grid) depth first. The stack holds one frame per sequence on the current
+# path: its generator of functional neighbors, the changes that restore its parent sequence, and its path length.
+# The path sequence is changed in place as the path extends and restored as it backtracks.
+def walk_paths(grid, seq, strides, pathlen, target_min, target_aa, pathinfo, neighbors):
+    seq = seq.copy()
+    idx = sum(aa*stride for aa, stride in zip(seq, strides))
+    # Block start sequence from becoming part of other paths. It is explored whether or not it is functional.
+    grid[idx] = 1
+    pathlen += 1
+    if record_seq(seq, pathlen, target_min, target_aa, pathinfo):
+        return
     
+    stack = [(neighbors(seq, idx), (), pathlen)]
+    while stack:
+        seq_neighbors, restore, pathlen = stack[-1]
+        for newidx, changes, added_len in seq_neighbors:
+            # Block neighbor from becoming part of other paths. 
+            grid[newidx] = 1
+            newpathlen = pathlen + added_len + 1
+            # Do not extend paths longer than PATH_MAX. 
+            if newpathlen <= PATH_MAX:
+                break
+        else:
+            # Backtrack once all neighbors of the sequence have been explored
+            stack.pop()
+            for pos, aa in restore:
+                seq[pos] = aa
+            continue
+        
+        newrestore = [(pos, seq[pos]) for pos, aa in reversed(changes)]
+        for pos, aa in changes:
+            seq[pos] = aa
+        if record_seq(seq, newpathlen, target_min, target_aa, pathinfo):
+            return
+        stack.append((neighbors(seq, newidx), newrestore, newpathlen))
+
+
+#############################################
+# Each search_path_s function handles one value of steps, the maximum number of mutations between neighbors.
+# Its neighbors generator yields the index of each functional neighbor still unblocked when reached, the
+# (position, amino acid) changes leading to it, and the path length added on top of one step.
+def search_path_s1(grid, length, aanum, target_min, seq, target_aa, pathlen, pathinfo, rng):
+    # Amino acids that can replace each amino acid if TRANSITIONS = "Reduced"
+    reduced_aa = [[(aa + shift) % aanum for shift in REDUCED_SHIFTS] for aa in range(aanum)]
+    # Rows of amino acids shuffled into the orderings drawn for each sequence
+    aa_rows = np.tile(np.arange(aanum, dtype=np.min_scalar_type(aanum)), (length, 1))
+    strides = grid_strides(length, aanum)
     
-    # Explore different paths to see if a functional sequence resides within "steps" mutations
-    aas = [item for item in range(aanum)]
-    if steps == 1:
+    # Explore paths to functional sequences one mutation away
+    def neighbors(seq, idx):
+        if TRANSITIONS == "All":
+            aa_orders = shuffle_aas(rng, aa_rows, length)
         for pos_change in range(length):
+            stride = strides[pos_change]
+            base = idx - seq[pos_change]*stride
             if TRANSITIONS == "All":
-                trans_aa = random.sample(aas, aanum)
+                trans_aa = next(aa_orders)
             elif TRANSITIONS == "Reduced":
-                old_aa = seq[pos_change]
-                # This line can be adjusted for fewer or more transitions. Currently, two amino acids below and above the current amino acid are included.
-                trans_aa = [(old_aa-2)%aanum, (old_aa-1)%aanum, (old_aa+1)%aanum, (old_aa+2)%aanum]    
+                trans_aa = reduced_aa[seq[pos_change]]
             for newaa in trans_aa:
-                newseq = seq.copy()
-                newseq[pos_change] = newaa
-                if retrieve(mat, newseq, len(newseq)) < proportion:
-                    search_path(mat, length, aanum, proportion, steps, tol, newseq, target_seq, pathlen, pathinfo)
-    elif steps == 2:
+                newidx = base + newaa*stride
+                if grid[newidx] == 0:
+                    yield newidx, ((pos_change, newaa),), 0
+    
+    walk_paths(grid, seq, strides, pathlen, target_min, target_aa, pathinfo, neighbors)
+
+
+def search_path_s2(grid, length, aanum, target_min, seq, target_aa, pathlen, pathinfo, rng):
+    # Rows of amino acids shuffled into the orderings drawn for each sequence. Changing a position twice is only 
+    # explored after its first new amino acid (see neighbors), so m = length - pos_change1 positions left need 
+    # 1 + m + (aanum-1)*(m-1) orderings.
+    aa_rows_num = length + length*(length+1)//2 + (aanum-1)*length*(length-1)//2
+    aa_rows = np.tile(np.arange(aanum, dtype=np.min_scalar_type(aanum)), (aa_rows_num, 1))
+    strides = grid_strides(length, aanum)
+    
+    # Explore paths to functional sequences up to two mutations away
+    def neighbors(seq, idx):
+        aa_orders = shuffle_aas(rng, aa_rows, aa_rows_num)
         for pos_change1 in range(length):
-            for newaa1 in random.sample(aas, aanum):
-                for pos_change2 in range(pos_change1, length):
-                    for newaa2 in random.sample(aas, aanum):
-                        newseq = seq.copy()
-                        newseq[pos_change1] = newaa1
-                        newseq[pos_change2] = newaa2                   
-                        if retrieve(mat, newseq, len(newseq)) < proportion:
+            stride1 = strides[pos_change1]
+            base1 = idx - seq[pos_change1]*stride1
+            # Changing pos_change1 again reaches the same sequences whatever newaa1 is. After the first newaa1 
+            # they are all blocked, so only later positions are explored.
+            pos_start2 = pos_change1
+            for newaa1 in next(aa_orders):
+                idx1 = base1 + newaa1*stride1
+                for pos_change2 in range(pos_start2, length):
+                    stride2 = strides[pos_change2]
+                    base2 = idx1 - (newaa1 if pos_change2 == pos_change1 else seq[pos_change2])*stride2
+                    for newaa2 in next(aa_orders):
+                        newidx = base2 + newaa2*stride2
+                        if grid[newidx] == 0:
+                            changes = ((pos_change1, newaa1), (pos_change2, newaa2))
                             if pos_change1 != pos_change2:
-                                search_path(mat, length, aanum, proportion, steps, tol, newseq, target_seq, pathlen+2, pathinfo)
+                                yield newidx, changes, 2
                             else:
-                                search_path(mat, length, aanum, proportion, steps, tol, newseq, target_seq, pathlen+1, pathinfo)
-    elif steps == 3:
+                                yield newidx, changes, 1
+                pos_start2 = pos_change1 + 1
+    
+    walk_paths(grid, seq, strides, pathlen, target_min, target_aa, pathinfo, neighbors)
+
+
+def search_path_s3(grid, length, aanum, target_min, seq, target_aa, pathlen, pathinfo, rng):
+    # Rows of amino acids shuffled into the orderings drawn for each sequence and, within it, for each first mutation.
+    # Changing a position twice in a row is only explored after its first new amino acid (see neighbors), so a first 
+    # mutation with k positions left for the second needs k + k*(k+1)/2 + (aanum-1)*k*(k-1)/2 orderings.
+    aa_rows_num = [k + k*(k+1)//2 + (aanum-1)*k*(k-1)//2 for k in range(length+1)]
+    aa_rows = np.tile(np.arange(aanum, dtype=np.min_scalar_type(aanum)), (max(length, aa_rows_num[length]), 1))
+    strides = grid_strides(length, aanum)
+    
+    # Explore paths to functional sequences up to three mutations away
+    def neighbors(seq, idx):
+        aa_orders1 = shuffle_aas(rng, aa_rows, length)
         for pos_change1 in range(length):
-            for newaa1 in random.sample(aas, aanum):
-                for pos_change2 in range(pos_change1, length):
-                    for newaa2 in random.sample(aas, aanum):
-                        for pos_change3 in range(pos_change2, length):
-                            for newaa3 in random.sample(aas, aanum):
-                                newseq = seq.copy()
-                                newseq[pos_change1] = newaa1
-                                newseq[pos_change2] = newaa2                   
-                                newseq[pos_change3] = newaa3                   
-                                if retrieve(mat, newseq, len(newseq)) < proportion:
+            stride1 = strides[pos_change1]
+            base1 = idx - seq[pos_change1]*stride1
+            # Changing a position again reaches the same sequences whatever its previous new amino acid is. After 
+            # the first one they are all blocked, so only later positions are explored.
+            pos_start2 = pos_change1
+            for newaa1 in next(aa_orders1):
+                idx1 = base1 + newaa1*stride1
+                aa_orders = shuffle_aas(rng, aa_rows, aa_rows_num[length - pos_start2])
+                for pos_change2 in range(pos_start2, length):
+                    stride2 = strides[pos_change2]
+                    base2 = idx1 - (newaa1 if pos_change2 == pos_change1 else seq[pos_change2])*stride2
+                    pos_start3 = pos_change2
+                    for newaa2 in next(aa_orders):
+                        idx2 = base2 + newaa2*stride2
+                        for pos_change3 in range(pos_start3, length):
+                            stride3 = strides[pos_change3]
+                            base3 = idx2 - (newaa2 if pos_change3 == pos_change2 else seq[pos_change3])*stride3
+                            for newaa3 in next(aa_orders):
+                                newidx = base3 + newaa3*stride3
+                                if grid[newidx] == 0:
+                                    changes = ((pos_change1, newaa1), (pos_change2, newaa2), (pos_change3, newaa3))
                                     if pos_change1 != pos_change2 and pos_change2 != pos_change3:
-                                        search_path(mat, length, aanum, proportion, steps, tol, newseq, target_seq, pathlen+3, pathinfo, True)
+                                        yield newidx, changes, 3
                                     elif pos_change1 != pos_change2 or pos_change2 != pos_change3:
-                                        search_path(mat, length, aanum, proportion, steps, tol, newseq, target_seq, pathlen+2, pathinfo, True)
+                                        yield newidx, changes, 2
                                     else:
-                                        search_path(mat, length, aanum, proportion, steps, tol, newseq, target_seq, pathlen+1, pathinfo, True)
-    else:
-        print("Steps: %d not included" % steps)
-        sys.exit("\n")
+                                        yield newidx, changes, 1
+                        pos_start3 = pos_change2 + 1
+                pos_start2 = pos_change1 + 1
+    
+    walk_paths(grid, seq, strides, pathlen, target_min, target_aa, pathinfo, neighbors)
+
+
+SEARCH_PATHS = {1: search_path_s1, 2: search_path_s2, 3: search_path_s3}     # Search function for each value of steps
 
-    return
 
 #############################################
-# Run separate processes to search all p values PARALLEL_PROC times in parallel
-def perc_process(process_num):
+# Numba versions of the search functions. They index the flat grid with an int64 strides array, 
+# shuffle amino acids in place with Numba's random generator, and return results in pathinfo_arr: 
+# [cluster size, 1 if cluster is large, 1 if path found, path length to target].
+
+# Seed Numba's random generator, which is separate from numpy's
+@njit(cache=True)
+def seed_numba(seed):
+    np.random.seed(seed)
+
+
+# Decode sequence at idx into seq and update pathinfo_arr. Return True if all searches should end.
+@njit(cache=True)
+def record_seq_nb(strides, aanum, idx, pathlen, seq, sim_code, target_min, target_aa, pathinfo_arr):
+    for pos in range(strides.shape[0]):
+        seq[pos] = (idx // strides[pos]) % aanum
+    if sim_code == 0:                               # Cluster
+        pathinfo_arr[0] += 1
+    elif sim_code == 1:                             # Percent
+        pathinfo_arr[0] += 1
+        if pathinfo_arr[0] >= CLUSTER_MAX:
+            pathinfo_arr[1] = 1
+            return True
+    else:                                           # Attempts
+        # Stop checking once more than length - target_min positions differ from the target
+        different = 0
+        for pos in range(seq.shape[0]):
+            if seq[pos] != target_aa:
+                different += 1
+                if different > seq.shape[0] - target_min:
+                    return False
+        pathinfo_arr[2] = 1
+        pathinfo_arr[3] = pathlen
+        return True
+    return False
+
+
+@njit(cache=True)
+def search_path_nb_s1(mat_flat, strides, aanum, sim_code, target_min, target_aa, start_idx, pathlen, reduced_aa, all_trans, shuffle, pathinfo_arr):
+    length = strides.shape[0]
+    seq = np.empty(length, dtype=np.int64)
+    perm = np.arange(aanum)
+    stack = [(start_idx, pathlen)]
+    while len(stack) > 0:
+        idx, pathlen = stack.pop()
+        if mat_flat[idx] == 1:
+            continue
+        mat_flat[idx] = 1
+        pathlen += 1
+        if pathlen > PATH_MAX:
+            continue
+        if record_seq_nb(strides, aanum, idx, pathlen, seq, sim_code, target_min, target_aa, pathinfo_arr):
+            return
+        
+        # Push neighbors in reverse order of search_path_s1 so that they are popped in its order
+        for pos_change in range(length-1, -1, -1):
+            stride = strides[pos_change]
+            base = idx - seq[pos_change]*stride
+            if all_trans:
+                if shuffle:
+                    np.random.shuffle(perm)
+                trans_aa = perm
+            else:
+                trans_aa = reduced_aa[seq[pos_change]]
+            for k in range(trans_aa.shape[0]-1, -1, -1):
+                newidx = base + trans_aa[k]*stride
+                if mat_flat[newidx] == 0:
+                    stack.append((newidx, pathlen))
+
+
+@njit(cache=True)
+def search_path_nb_s2(mat_flat, strides, aanum, sim_code, target_min, target_aa, start_idx, pathlen, reduced_aa, all_trans, shuffle, pathinfo_arr):
+    length = strides.shape[0]
+    seq = np.empty(length, dtype=np.int64)
+    perm1 = np.arange(aanum)
+    perm2 = np.arange(aanum)
+    stack = [(start_idx, pathlen)]
+    while len(stack) > 0:
+        idx, pathlen = stack.pop()
+        if mat_flat[idx] == 1:
+            continue
+        mat_flat[idx] = 1
+        pathlen += 1
+        if pathlen > PATH_MAX:
+            continue
+        if record_seq_nb(strides, aanum, idx, pathlen, seq, sim_code, target_min, target_aa, pathinfo_arr):
+            return
+        
+        # Push neighbors in reverse order of search_path_s2 so that they are popped in its order. The path length 
+        # added depends on the order, since a neighbor can be reached both by one and by two changed positions.
+        for pos_change1 in range(length-1, -1, -1):
+            stride1 = strides[pos_change1]
+            base1 = idx - seq[pos_change1]*stride1
+            if shuffle:
+                np.random.shuffle(perm1)
+            for k1 in range(aanum-1, -1, -1):
+                newaa1 = perm1[k1]
+                idx1 = base1 + newaa1*stride1
+                # Changing pos_change1 again is only explored for the first newaa1 of the search order, as in 
+                # search_path_s2. That is perm1[0], whose neighbors are pushed last.
+                pos_end2 = pos_change1 - 1 if k1 == 0 else pos_change1
+                for pos_change2 in range(length-1, pos_end2, -1):
+                    stride2 = strides[pos_change2]
+                    base2 = idx1 - (newaa1 if pos_change2 == pos_change1 else seq[pos_change2])*stride2
+                    if shuffle:
+                        np.random.shuffle(perm2)
+                    for k2 in range(aanum-1, -1, -1):
+                        newidx = base2 + perm2[k2]*stride2
+                        if mat_flat[newidx] == 0:
+                            stack.append((newidx, pathlen + 1 + (pos_change1 != pos_change2)))
+
+
+@njit(cache=True)
+def search_path_nb_s3(mat_flat, strides, aanum, sim_code, target_min, target_aa, start_idx, pathlen, reduced_aa, all_trans, shuffle, pathinfo_arr):
+    length = strides.shape[0]
+    seq = np.empty(length, dtype=np.int64)
+    perm1 = np.arange(aanum)
+    perm2 = np.arange(aanum)
+    perm3 = np.arange(aanum)
+    stack = [(start_idx, pathlen)]
+    while len(stack) > 0:
+        idx, pathlen = stack.pop()
+        if mat_flat[idx] == 1:
+            continue
+        mat_flat[idx] = 1
+        pathlen += 1
+        if pathlen > PATH_MAX:
+            continue
+        if record_seq_nb(strides, aanum, idx, pathlen, seq, sim_code, target_min, target_aa, pathinfo_arr):
+            return
+        
+        # Push neighbors in reverse order of search_path_s3 so that they are popped in its order (see search_path_nb_s2)
+        for pos_change1 in range(length-1, -1, -1):
+            stride1 = strides[pos_change1]
+            base1 = idx - seq[pos_change1]*stride1
+            if shuffle:
+                np.random.shuffle(perm1)
+            for k1 in range(aanum-1, -1, -1):
+                newaa1 = perm1[k1]
+                idx1 = base1 + newaa1*stride1
+                # Changing a position again is only explored for its first new amino acid in the search order, as in 
+                # search_path_s3. That is perm1[0] or perm2[0], whose neighbors are pushed last.
+                pos_end2 = pos_change1 - 1 if k1 == 0 else pos_change1
+                for pos_change2 in range(length-1, pos_end2, -1):
+                    stride2 = strides[pos_change2]
+                    base2 = idx1 - (newaa1 if pos_change2 == pos_change1 else seq[pos_change2])*stride2
+                    if shuffle:
+                        np.random.shuffle(perm2)
+                    for k2 in range(aanum-1, -1, -1):
+                        newaa2 = perm2[k2]
+                        idx2 = base2 + newaa2*stride2
+                        pos_end3 = pos_change2 - 1 if k2 == 0 else pos_change2
+                        for pos_change3 in range(length-1, pos_end3, -1):
+                            stride3 = strides[pos_change3]
+                            base3 = idx2 - (newaa2 if pos_change3 == pos_change2 else seq[pos_change3])*stride3
+                            if shuffle:
+                                np.random.shuffle(perm3)
+                            for k3 in range(aanum-1, -1, -1):
+                                newidx = base3 + perm3[k3]*stride3
+                                if mat_flat[newidx] == 0:
+                                    stack.append((newidx, pathlen + 1 + (pos_change1 != pos_change2) + (pos_change2 != pos_change3)))
+
+
+SEARCH_PATHS_NB = {1: search_path_nb_s1, 2: search_path_nb_s2, 3: search_path_nb_s3}
+
+
+#############################################
+# Search a dense flat grid with the Numba function search_path_nb and copy its results into pathinfo. 
+# Amino acids are not shuffled if rng is None (see check_searches.py).
+def search_path_numba(search_path_nb, mat_flat, length, aanum, target_min, seq, target_aa, pathlen, pathinfo, rng):
+    strides = np.array(grid_strides(length, aanum), dtype=np.int64)
+    reduced_aa = np.array([[(aa + shift) % aanum for shift in REDUCED_SHIFTS] for aa in range(aanum)], dtype=np.int64)
+    pathinfo_arr = np.zeros(4, dtype=np.int64)
+    start_idx = int(np.dot(seq, strides))
+    mat_flat[start_idx] = 0             # Explore the start sequence whether or not it is functional
+    search_path_nb(mat_flat, strides, aanum, SIMULATION_TYPES.index(SIMULATION_TYPE), target_min, target_aa, 
+                   start_idx, pathlen, reduced_aa, TRANSITIONS == "All", rng is not None, pathinfo_arr)
     if SIMULATION_TYPE == "Cluster":
-        process_file = PROCESS_FILE_BASE + "_cl" + str(process_num) + ".csv"
-        test_datafile(process_file, COLUMNS_CLUSTER)
-        pathinfo = {"Cluster": 0}
+        pathinfo.cluster = int(pathinfo_arr[0])
     elif SIMULATION_TYPE == "Percent":
-        process_file = PROCESS_FILE_BASE + "_plg" + str(process_num) + ".csv"
-        test_datafile(process_file, COLUMNS_PERC_LARGE)
-        pathinfo = {"Cluster": 0, "Size": "Small"}
+        pathinfo.cluster = int(pathinfo_arr[0])
+        pathinfo.large = bool(pathinfo_arr[1])
     elif SIMULATION_TYPE == "Attempts":
-        process_file = PROCESS_FILE_BASE + "_att" + str(process_num) + ".csv"
-        test_datafile(process_file, COLUMNS_ATTEMPTS)
-        pathinfo = {"Path Found": False, "Path Len Target": 0}        
-    
+        pathinfo.path_found = bool(pathinfo_arr[2])
+        pathinfo.path_len_target = int(pathinfo_arr[3])
+
+
+#############################################
+# Random number generator of the trials run in this process. It is replaced by seed_process in each pool process,
+# but also lets run_one_trial be called directly, e.g. from a serial run.
+rng = np.random.default_rng()
+
+
+#############################################
+# Create the random number generators of a process from seed. With seed None, they are seeded separately in each
+# process from fresh entropy.
+def seed_process(seed=None):
+    global rng
+    rng = np.random.default_rng(seed)
+    if USE_NUMBA and NUMBA_INSTALLED and GRID == "Dense":
+        seed_numba(int(rng.integers(2**32)))
+
+
+#############################################
+# Run one trial with the parameters of a row of trials_params.csv and return its result
+def run_one_trial(trial):
+    trial_num, process_num, length, aanum, proportion, tol, steps = trial
+    # Seed each trial by its number so that results do not depend on which process runs it
+    if SEED is not None:
+        seed_process([SEED, trial_num])
+    pathinfo = PathInfo()           # Initialize search results
     pid = getpid()
-    
-    # Iterate through trials in trials_params.csv
+    if USE_NUMBA and NUMBA_INSTALLED and GRID == "Dense":
+        search_path = partial(search_path_numba, SEARCH_PATHS_NB[steps])
+    else:
+        search_path = SEARCH_PATHS[steps]
+
+    # Allocate dense grid of dimensions length and size aanum. Attempts reuse it for every landscape.
+    mat = np.empty((aanum,)*length, dtype=np.uint8) if GRID == "Dense" else None
+
+    # Create initial sequence and set amino acid of target sequence
+    initial_seq = [0]*length
+    target_aa = 1                   # Target sequence is composed entirely of the second amino acid
+    target_min = length - tol       # Minimum number of positions matching the target for a sequence inside the target
+
+    if SIMULATION_TYPE == "Cluster":
+        # Initialize variables and matrix
+        pathlen = -1
+        grid = new_grid(mat, length, aanum, rng, proportion)
+
+        # Search through matricies for all paths
+        search_path(grid, length, aanum, target_min, initial_seq, target_aa, pathlen, pathinfo, rng)
+
+        # Record results
+        trial_row = [length, aanum, process_num, pid, proportion, pathinfo.cluster]
+    elif SIMULATION_TYPE == "Percent":
+        # Initialize variables and matrix
+        pathlen = -1
+        grid = new_grid(mat, length, aanum, rng, proportion)
+
+        # Search through matricies for all paths
+        search_path(grid, length, aanum, target_min, initial_seq, target_aa, pathlen, pathinfo, rng)
+
+        # Record results
+        trial_row = [length, aanum, process_num, pid, proportion, "Large" if pathinfo.large else "Small"]
+    elif SIMULATION_TYPE == "Attempts":
+        # Search through matricies until target found
+        attempts = 0
+        while pathinfo.path_found == False:
+            pathlen = -1                      # initialize path length
+            grid = new_grid(mat, length, aanum, rng, proportion)   # Initialize matrix
+            search_path(grid, length, aanum, target_min, initial_seq, target_aa, pathlen, pathinfo, rng)
+            attempts += 1
+
+        # Record results
+        trial_row = [length, aanum, process_num, pid, proportion, attempts, pathinfo.path_len_target]
+
+    return(trial_row)
+
+
+################### Main Program ##########################
+
+if SIMULATION_TYPE not in SIMULATION_TYPES:
+    sys.exit("You did not choose a valid simulation type. \nSIMULATION_TYPE must equal \"Cluster\", \"Percent\", or \"Attempts\"")
+
+if __name__ == '__main__':
+    # Read trials from trials_params.csv. Every row is run Repeat times by each of PARALLEL_PROC process numbers.
+    trials = []
     trials_params = pd.read_csv(TRIALS_PARAMS_FILE)
     for index, row in trials_params.iterrows():
-        # Read run parameters from file
         length = int(row['Length'])
         aanum = int(row['AA Num'])
-        proportion = float(row['Proportion'])
-        tol = int(row['Tol'])
         steps = int(row['Steps'])
-        repeat = int(row['Repeat'])
-
-        # Create initial and target sequences
-        initial_seq = [0]*length
-        target_seq = [1]*length
-        
-        # Run traials for same paramaeters repeat times.
-        for run in range(repeat):
-            if SIMULATION_TYPE == "Cluster":
-                # Initialize variables and matrix
-                pathlen = -1
-                pathinfo["Cluster"] = 0
-                mat = initialize(length, aanum)
-                
-                # Search through matricies for all paths
-                search_path(mat, length, aanum, proportion, steps, tol, initial_seq, target_seq, pathlen, pathinfo)
-        
-                # Record results to file
-                trial_data = [length, aanum, process_num, pid, proportion, pathinfo["Cluster"]]
-                process_data = pd.read_csv(process_file)
-                process_data.loc[len(process_data.index)] = trial_data
-                process_data[['Length', 'AA Num', 'Process', 'PID', 'Cluster']] = process_data[['Length', 'AA Num', 'Process', 'PID', 'Cluster']].astype('int64')
-                process_data.to_csv(process_file, encoding='utf-8', index=False)
-            elif SIMULATION_TYPE == "Percent":
-                # Initialize variables and matrix
-                pathlen = -1
-                pathinfo["Cluster"] = 0
-                pathinfo["Size"] = "Small"                
-                mat = initialize(length, aanum)
-                
-                # Search through matricies for all paths
-                search_path(mat, length, aanum, proportion, steps, tol, initial_seq, target_seq, pathlen, pathinfo)
-    
-                # Record results to file
-                process_data = [length, aanum, process_num, pid, proportion, pathinfo["Size"]]
-                perc_data = pd.read_csv(process_file)
-                perc_data.loc[len(perc_data.index)] = process_data
-                perc_data[['Length', 'AA Num', 'Process', 'PID']] = perc_data[['Length', 'AA Num', 'Process', 'PID']].astype('int64')
-                perc_data.to_csv(process_file, encoding='utf-8', index=False)
-                
-            elif SIMULATION_TYPE == "Attempts":
-                # Initialize variables
-                pathinfo["Path Found"] = False
-                pathinfo["Path Len Target"] = 0
-                attempts = 0
-
-                # Search through matricies until target found 
-                while pathinfo["Path Found"] == False:
-                    pathlen = -1                      # initialize path length
-                    mat = initialize(length, aanum)   # Initialize matrix
-                    search_path(mat, length, aanum, proportion, steps, tol, initial_seq, target_seq, pathlen, pathinfo)
-                    attempts += 1
-        
-                # Record results to file
-                output_data = [length, aanum, process_num, pid, proportion, attempts, pathinfo["Path Len Target"]]
-                perc_data = pd.read_csv(process_file)
-                perc_data.loc[len(perc_data.index)] = output_data
-                perc_data[['Length', 'AA Num', 'Process', 'PID', 'Attempts', 'Path Len']] = perc_data[['Length', 'AA Num', 'Process', 'PID', 'Attempts', 'Path Len']].astype('int64')
-                perc_data.to_csv(process_file, encoding='utf-8', index=False)                
+        if length < 1:
+            print("Dimension %d not included" % length)
+            sys.exit("\n")
+        if steps not in SEARCH_PATHS:
+            print("Steps: %d not included" % steps)
+            sys.exit("\n")
+        for process_num in range(1, PARALLEL_PROC+1):
+            for run in range(int(row['Repeat'])):
+                trials.append((len(trials), process_num, length, aanum, float(row['Proportion']), int(row['Tol']), steps))
     
+    # Start the trials with the most neighbors per sequence first so that long trials do not finish last on their own
+    trials.sort(key = lambda trial: trial[3]**trial[6] * trial[2], reverse = True)
 
-################### Main Program ##########################
-
-sys.setrecursionlimit(PATH_MAX + 1000)
-simulation_types = ['Cluster', 'Percent', 'Attempts']
-if SIMULATION_TYPE not in simulation_types:
-    sys.exit("You did not choose a valid simulation type. \nSIMULATION_TYPE must equal \"Cluster\", \"Percent\", or \"Attempts\"")
+    # Run the trials in a pool of PARALLEL_PROC processes. Each process takes the next trial as soon as it is free.
+    with multiprocessing.Pool(PARALLEL_PROC, initializer=seed_process) as pool:
+        new_rows = list(pool.imap_unordered(run_one_trial, trials, chunksize=1))
 
-if __name__ == '__main__':
-    processes = []
-    # Create PARALLEL_PROC processes for parallel computing
-    for process_num in range(PARALLEL_PROC):
-        process = multiprocessing.Process(target=perc_process, args=[process_num+1])
-        processes.append(process)
-        process.start()
-        
-    # Combine processes files into single output file. 
-    process_num = 0
-    frames = []
-    for process in processes:
-        process_num += 1
-        process.join()
-        if SIMULATION_TYPE == "Cluster":
-            proc_data_file = PROCESS_FILE_BASE + "_cl" + str(process_num) + ".csv"
-        elif SIMULATION_TYPE == "Percent":
-            proc_data_file = PROCESS_FILE_BASE + "_plg" + str(process_num) + ".csv"
-        elif SIMULATION_TYPE == "Attempts":
-            proc_data_file = PROCESS_FILE_BASE + "_att" + str(process_num) + ".csv"
-        perc_data = pd.read_csv(proc_data_file)
-        frames.append(perc_data)
-        os.remove(proc_data_file)
-
-    # Save data to the output file and open/create a file to write the average cluster size, percentage of large clusters, or average attempts
+    # Add the new results to the output file for individual trials. An output file with other column names is replaced.
     if SIMULATION_TYPE == "Cluster":
-        test_datafile(CL_OUTPUT_FILE, COLUMNS_CLUSTER)
-        output_old_data = pd.read_csv(CL_OUTPUT_FILE)
-        frames.append(output_old_data)
-        output_data = pd.concat(frames)
-        output_data.to_csv(CL_OUTPUT_FILE, encoding='utf-8', index=False)
+        output_file, output_columns = CL_OUTPUT_FILE, COLUMNS_CLUSTER
     elif SIMULATION_TYPE == "Percent":
-        test_datafile(PLG_OUTPUT_FILE, COLUMNS_PERC_LARGE)
-        output_old_data = pd.read_csv(PLG_OUTPUT_FILE)
-        frames.append(output_old_data)
-        output_data = pd.concat(frames)
-        output_data.to_csv(PLG_OUTPUT_FILE, encoding='utf-8', index=False)
+        output_file, output_columns = PLG_OUTPUT_FILE, COLUMNS_PERC_LARGE
     elif SIMULATION_TYPE == "Attempts":
-        test_datafile(ATT_OUTPUT_FILE, COLUMNS_ATTEMPTS)
-        output_old_data = pd.read_csv(ATT_OUTPUT_FILE)
-        frames.append(output_old_data)
-        output_data = pd.concat(frames)
-        output_data.to_csv(ATT_OUTPUT_FILE, encoding='utf-8', index=False) 
+        output_file, output_columns = ATT_OUTPUT_FILE, COLUMNS_ATTEMPTS
+    frames = [pd.DataFrame(new_rows, columns = output_columns)]
+    if os.path.exists(output_file):
+        output_old_data = pd.read_csv(output_file)
+        if output_old_data.columns.values.tolist() == output_columns:
+            frames.append(output_old_data)
+    # Cast columns once after combining the results. Columns read from an output file without trials have object dtype.
+    column_types = {column: 'int64' for column in output_columns}
+    column_types['Proportion'] = 'float64'
+    if SIMULATION_TYPE == "Percent":
+        column_types['Size'] = 'str'
+    output_data = pd.concat(frames).astype(column_types)
+    output_data.to_csv(output_file, encoding='utf-8', index=False)
 
-    # Calculate average cluster size, percent large clusters, or average attempts and same to output file. 
+    # Calculate average cluster size, percent large clusters, or average attempts for each length, number of amino acids, and proportion and save to output file. 
+    group_columns = ['Length', 'AA Num', 'Proportion']
     if SIMULATION_TYPE == "Cluster":
-        output_ave = pd.DataFrame(columns = COLUMNS_CLAV)     
+        output_ave = output_data.groupby(group_columns, as_index=False).agg(**{
+            'Cluster Ave': ('Cluster', 'mean'), 'STD': ('Cluster', 'std'), 'Trials': ('Cluster', 'size')})
+        output_ave['STD'] = output_ave['STD'] / np.sqrt(output_ave['Trials'])
+        output_ave = output_ave[COLUMNS_CLAV].round({'Cluster Ave': 1, 'STD': 1})
         output_file = CLAV_OUTPUT_FILE
     elif SIMULATION_TYPE == "Percent":
-        output_ave = pd.DataFrame(columns = COLUMNS_PLGAV) 
+        # Calculate percentage of large clusters
+        output_ave = output_data.assign(Large = output_data.Size == "Large").groupby(group_columns, as_index=False).agg(**{
+            'Perc Large': ('Large', 'mean'), 'Trials': ('Large', 'size')})
+        output_ave['Perc Large'] = output_ave['Perc Large'].round(2)
+        output_ave['STD'] = np.sqrt(output_ave['Perc Large'] * (1 - output_ave['Perc Large']) / output_ave['Trials']).round(3)
+        output_ave = output_ave[COLUMNS_PLGAV]
         output_file = PLGAV_OUTPUT_FILE
     elif SIMULATION_TYPE == "Attempts":        
-        output_ave = pd.DataFrame(columns = COLUMNS_ATTAV) 
+        output_ave = output_data.groupby(group_columns, as_index=False).agg(**{
+            'Attempts Ave': ('Attempts', 'mean'), 'Att STD': ('Attempts', 'std'),
+            'Path Len Ave': ('Path Len', 'mean'), 'Len STD': ('Path Len', 'std'), 'Trials': ('Attempts', 'size')})
+        output_ave['Att STD'] = output_ave['Att STD'] / np.sqrt(output_ave['Trials'])
+        output_ave['Len STD'] = output_ave['Len STD'] / np.sqrt(output_ave['Trials'])
+        output_ave = output_ave[COLUMNS_ATTAV].round({'Attempts Ave': 1, 'Att STD': 1, 'Path Len Ave': 1, 'Len STD': 1})
         output_file = ATTAV_OUTPUT_FILE
-
-    length_set = list(set(output_data.Length))                      # List of sequence lengths in output data
-    for length in length_set:
-        output_length = output_data[output_data.Length==length]
-        proportion_set = list(set(output_length.Proportion))        # List of proportions for each length
-        for proportion in proportion_set:
-            output_len_prop = output_length[output_length.Proportion==proportion]
-            sample = len(output_len_prop)
-            aa_num = output_len_prop.iloc[0]['AA Num']
-            # Average relevant variable(s) for simulation type
-            if SIMULATION_TYPE == "Cluster":
-                cluster_av = round(output_len_prop["Cluster"].mean(),1)      # Calculate average cluster size
-                cluster_std = round(output_len_prop["Cluster"].std()/math.sqrt(sample),1)     # Calculate average cluster size
-                output_avdata = [length, aa_num, proportion, cluster_av, cluster_std, sample]
-            elif SIMULATION_TYPE == "Percent":
-                # Calculate percentage of large clusters
-                percent_lg = round(len(output_len_prop[output_len_prop.Size == "Large"]) / sample, 2)
-                perclg_std = round(math.sqrt(percent_lg * (1 - percent_lg) / sample), 3)
-                output_avdata = [length, aa_num, proportion, percent_lg, perclg_std, sample]
-            elif SIMULATION_TYPE == "Attempts":
-                attempts_ave = round(output_len_prop["Attempts"].mean(), 1)
-                attempts_std = round(output_len_prop["Attempts"].std()/math.sqrt(sample), 1)
-                path_len_ave = round(output_len_prop["Path Len"].mean(), 1) 
-                path_len_std = round(output_len_prop["Path Len"].std()/math.sqrt(sample) , 1)
-                output_avdata = [length, aa_num, proportion, attempts_ave, attempts_std, path_len_ave, path_len_std, sample]
-            output_ave.loc[len(output_ave.index)] = output_avdata   
-            output_ave[['Length', 'AA Num', 'Trials']] = output_ave[['Length', 'AA Num', 'Trials']].astype('int64')      
     output_ave.to_csv(output_file, encoding='utf-8', index=False)     
 
     print("All percolation processes have finished")